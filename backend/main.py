@@ -1,24 +1,62 @@
 import os
+import sys
+import asyncio
+import base64
+import contextlib
+import functools
+import hashlib
 import io
-import google.generativeai as genai
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Depends
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import threading
+import time
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Depends, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from PIL import Image
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.datastructures import Headers
+from PIL import Image, ImageOps, UnidentifiedImageError, features
 import uvicorn
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field
+import orjson
 import smtplib
 import ssl
 from email.message import EmailMessage
 from dotenv import load_dotenv
-from typing import Optional 
+from typing import TYPE_CHECKING, Optional 
 from pathlib import Path
-from googleapiclient.discovery import build 
+from cachetools import TTLCache
 
 # --- SIMPLIFIED .env LOADING ---
 # This will load the .env file if it exists (on your computer)
 # On Vercel, it will do nothing, and the Vercel environment variables will be used instead.
 load_dotenv() 
 
+# --- Logging ---
+# Request handlers only enqueue log records; a listener thread does the
+# formatting and the (blocking) write to stderr. The app logger doesn't
+# propagate, so uvicorn's own logging setup is left alone. The listener is
+# started per worker process (in the app lifespan, or on Celery worker
+# process init); records logged before that are written once it starts.
+_log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+
+# An unknown LOG_LEVEL falls back to INFO instead of failing the import.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+_log_level_valid = isinstance(logging.getLevelName(LOG_LEVEL), int)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL if _log_level_valid else logging.INFO)
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+logger.propagate = False
+if not _log_level_valid:
+    logger.warning("Unknown LOG_LEVEL %r, using INFO", LOG_LEVEL)
+
 # 1. Load Environment Variables
 API_KEY = os.getenv("GEMINI_API_KEY")
 SENDER_EMAIL = os.getenv("SENDER_EMAIL")
@@ -26,6 +64,9 @@ SENDER_APP_PASSWORD = os.getenv("SENDER_APP_PASSWORD")
 YOUR_NAME = "DeviceDigiHelp Support"
 CUSTOM_SEARCH_API_KEY = os.getenv("CUSTOM_SEARCH_API_KEY")
 SEARCH_ENGINE_ID = os.getenv("SEARCH_ENGINE_ID")
+# Optional: only needed when the background job queue is used.
+CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL")
+CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", CELERY_BROKER_URL)
 
 # 2. Validate Environment Variables
 # We check this *after* load_dotenv()
@@ -41,92 +82,212 @@ if not SEARCH_ENGINE_ID:
     raise ValueError("SEARCH_ENGINE_ID environment variable not set. Please set it in your .env file or Vercel settings.")
 
 # 3. Configure Gemini
-genai.configure(api_key=API_KEY)
-
-# --- Prompts (Unchanged) ---
-MANUAL_SYSTEM_PROMPT_TEMPLATE = """You are an expert tech assistant. A user has uploaded an image of a device.
-You MUST generate your entire response in the following language: {language}.
-Your response must be formatted in simple HTML.
-
-1.  **Device Identification:** Start with a single line identifying the device. **Only bold the device name itself**. (e.g., "This appears to be an <b>Apple iPhone 14 Pro</b>.").
-2.  **Quick Start Guide:**
-    * Provide a clear, step-by-step 'Quick Start Guide' with the most essential, basic functions.
-    * Focus on what a brand new user would need to know (e.g., How to turn on/off, main controls, core function).
-    * Be easily understandable and to the point.
-    * This should be a detailed list, including as many basic steps as needed.
-3.  **Further Assistance:**
-    * After the guide, add a 'Further Assistance' section.
-    * Provide a list of 2-3 common follow-up questions.
-
-RULES FOR FORMATTING:
-- Use `<h3>` for main titles (like 'Quick Start Guide' and 'Further Assistance').
-- Use `<h4>` for sub-titles (like 'Setup', 'Core Functions').
-- Use `<ul>` and `<li>` for all bullet points and steps.
-- Use `<b>` and `</b>` for all bold text.
-- Do NOT use any markdown characters like '##', '###', '*', or '**'.
-"""
-
-TEXT_MANUAL_SYSTEM_PROMPT_TEMPLATE = """You are an expert tech assistant. A user has provided a device name.
-You MUST generate your entire response in the following language: {language}.
-Your response must be formatted in simple HTML.
-
-Your task is to generate a comprehensive, accurate, and easy-to-understand step-by-step guide for a beginner, based on the user's query.
-
-1.  **Device Identification:** Start with a single line confirming the device. **Only bold the device name itself**. (e.g., "Here is the guide for the <b>Apple iPhone 14 Pro</b>.").
-2.  **Quick Start Guide:**
-    * Provide a clear, step-by-step 'Quick Start Guide' with the most essential, basic functions.
-    * Focus on what a brand new user would need to know (e.g., How to turn on/off, main controls, core function).
-    * Be easily understandable and to the point.
-    * This should be a detailed list, including as many basic steps as needed.
-3.  **Further Assistance:**
-    * After the guide, add a 'Further Assistance' section.
-    * Provide a list of 2-3 common follow-up questions.
-
-RULES FOR FORMATTING:
-- Use `<h3>` for main titles (like 'Quick Start Guide' and 'Further Assistance').
-- Use `<h4>` for sub-titles (like 'Setup', 'Core Functions').
-- Use `<ul>` and `<li>` for all bullet points and steps.
-- Use `<b>` and `</b>` for all bold text.
-- Do NOT use any markdown characters like '##', '###', '*', or '**'.
-"""
-
-CHAT_SYSTEM_PROMPT_TEMPLATE = """You are a helpful, expert tech assistant. You are acting as a chatbot.
-The user has already identified a device, which will be provided as 'Device Context'.
-You MUST generate your entire response in the following language: {language}.
-Your job is to answer the user's follow-up questions with detailed, accurate, and step-by-step instructions.
-
-- Strict scope: only answer questions directly about the provided device context. If the user asks anything unrelated (general chit-chat, unrelated topics, other devices, or personal questions), respond with a brief refusal like: "I can help only with questions about this device."
-- Style: keep answers clear and simple. Prefer short sentences, bullet lists, and minimal fluff.
-
-- If the user provides an image with their question, use it as additional context (e.g., if they ask 'what is this button?' and provide an image, you must identify the button in the image).
-- If no image is provided, just answer the text question.
-- You must be able to answer any question, from simple to complex (e.g., "How do I add a fingerprint?", "How much detergent do I put in this washing machine?", "How do I print multiple copies?").
-- Provide clear, concise, and helpful answers.
-- Format your response with simple HTML (<b>, <ul>, <li>) for clarity.
-"""
+# The Gemini SDK is heavy to import; load and configure it on first use so
+# processes that only serve e.g. /contact-submit/ never pay for it.
+if TYPE_CHECKING:
+    import google.generativeai as genai
+
+GEMINI_MODEL_NAME = "gemini-2.5-flash-preview-09-2025"
+_genai = None
+_genai_lock = threading.Lock()
+
+def get_genai():
+    global _genai
+    if _genai is None:
+        with _genai_lock:
+            if _genai is None:
+                import google.generativeai as genai_module
+                genai_module.configure(api_key=API_KEY)
+                _genai = genai_module
+    return _genai
 
+# --- Prompts ---
+# The templates live in prompts.py. When main.py is run directly from inside
+# backend/, the `backend` package isn't importable, so fall back to a flat import.
 try:
-    generation_config = genai.GenerationConfig(
-        temperature=0.7,
-        top_p=1,
-        top_k=1,
-        max_output_tokens=8192,
+    from backend.prompts import (
+        MANUAL_SYSTEM_PROMPT_TEMPLATE,
+        TEXT_MANUAL_SYSTEM_PROMPT_TEMPLATE,
+        CHAT_SYSTEM_PROMPT_TEMPLATE,
+    )
+except ModuleNotFoundError:
+    from prompts import (
+        MANUAL_SYSTEM_PROMPT_TEMPLATE,
+        TEXT_MANUAL_SYSTEM_PROMPT_TEMPLATE,
+        CHAT_SYSTEM_PROMPT_TEMPLATE,
+    )
+
+# Generation settings shared by every model; they are baked into the cached
+# GenerativeModel instances rather than passed on each call.
+GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "top_p": 1,
+    "top_k": 1,
+    "max_output_tokens": 8192,
+}
+
+SAFETY_SETTINGS = [
+    {"category": category, "threshold": "BLOCK_NONE"}
+    for category in (
+        "HARM_CATEGORY_HARASSMENT",
+        "HARM_CATEGORY_HATE_SPEECH",
+        "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        "HARM_CATEGORY_DANGEROUS_CONTENT",
     )
-except Exception as e:
-    print(f"Error configuring generation: {e}")
+]
 
 # 4. Set up the FastAPI App
-app = FastAPI(title="Device DigiHelp API")
+# One-time setup and teardown for each worker process.
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    _log_listener.start()
+    try:
+        yield
+    finally:
+        close_smtp_pool()
+        _log_listener.stop()
+
+app = FastAPI(title="Device DigiHelp API", lifespan=lifespan)
+
+# --- Upload Size Limit ---
+# Oversized bodies are rejected from the Content-Length header before the
+# multipart body is parsed or spooled anywhere. Bodies without one (chunked
+# transfer) are counted as they are received and cut off with a 413 as soon
+# as they pass the limit, so at most MAX_UPLOAD_BYTES is ever spooled. It is
+# added before CORS so the CORS middleware wraps it and the 413 carries
+# Access-Control-Allow-Origin; otherwise the browser hides it as a network error.
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+UPLOAD_TOO_LARGE_DETAIL = "File too large. Maximum upload size is 10 MB."
+
+class UploadSizeLimitMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        content_length = Headers(scope=scope).get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES:
+            response = JSONResponse(status_code=413, content={"detail": UPLOAD_TOO_LARGE_DETAIL})
+            await response(scope, receive, send)
+            return
+
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > MAX_UPLOAD_BYTES:
+                    # Raised from inside body parsing; FastAPI re-raises
+                    # HTTPExceptions there and its exception handler sends the 413.
+                    raise HTTPException(status_code=413, detail=UPLOAD_TOO_LARGE_DETAIL)
+            return message
+
+        async def tracking_send(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except HTTPException as e:
+            # Only reached if nothing inside turned it into a response.
+            if e.status_code != 413 or response_started:
+                raise
+            response = JSONResponse(status_code=413, content={"detail": UPLOAD_TOO_LARGE_DETAIL})
+            await response(scope, receive, send)
+
+app.add_middleware(UploadSizeLimitMiddleware)
 
 # Configure CORS
+# Explicit origins (overridable with a comma-separated ALLOWED_ORIGINS) instead
+# of "*", and a one-day max_age so browsers cache preflight responses. The API
+# only serves GET/POST with JSON or multipart bodies and uses no cookies, so
+# methods and headers are fixed lists too.
+DEFAULT_ALLOWED_ORIGINS = [
+    "https://device-digihelp.vercel.app",
+    "https://device-digihelp-3q23.vercel.app",
+    "http://localhost:3000",
+    "http://localhost:5500",
+    "http://127.0.0.1:5500",
+]
+ALLOWED_ORIGINS = [
+    origin.strip() for origin in os.getenv("ALLOWED_ORIGINS", ",".join(DEFAULT_ALLOWED_ORIGINS)).split(",")
+    if origin.strip()
+]
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"], 
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=ALLOWED_ORIGINS,
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type"],
+    max_age=86400,
 )
 
+# Compress JSON/HTML responses (manual text shrinks several times over).
+# Streaming routes bypass it explicitly: older Starlette releases gzip
+# text/event-stream too, which buffers each SSE chunk. Level 5 gets nearly all
+# of level 9's savings on text at a fraction of the CPU.
+STREAMING_PATHS = ("/generate-manual/", "/generate-manual-from-text/", "/ask-follow-up/")
+
+class NonStreamingGZipMiddleware(GZipMiddleware):
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].endswith(STREAMING_PATHS):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+app.add_middleware(NonStreamingGZipMiddleware, minimum_size=500, compresslevel=5)
+
+# --- Upload Limits ---
+# Image types Gemini accepts directly; GIFs are accepted too and re-encoded.
+GEMINI_IMAGE_TYPES = {"image/jpeg", "image/png", "image/webp", "image/heic", "image/heif"}
+ALLOWED_IMAGE_TYPES = GEMINI_IMAGE_TYPES | {"image/gif"}
+
+def check_upload_size(file: UploadFile):
+    # Backstop for the streaming limit in UploadSizeLimitMiddleware.
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=UPLOAD_TOO_LARGE_DETAIL)
+
+# The declared content type is only a client claim; the first few bytes must
+# also match that type's signature before any hashing, decoding or uploading
+# happens. HEIC/HEIF share the ISO-BMFF container with MP4/MOV, so their
+# "ftyp" brand is checked too (either brand set is accepted for both types,
+# since phones label them inconsistently).
+HEIF_BRANDS = {b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"mif1", b"msf1"}
+
+def is_heif(header: bytes) -> bool:
+    return header[4:8] == b"ftyp" and header[8:12] in HEIF_BRANDS
+
+IMAGE_SIGNATURE_CHECKS = {
+    "image/jpeg": lambda header: header.startswith(b"\xff\xd8\xff"),
+    "image/png": lambda header: header.startswith(b"\x89PNG\r\n\x1a\n"),
+    "image/gif": lambda header: header[:6] in (b"GIF87a", b"GIF89a"),
+    "image/webp": lambda header: header[:4] == b"RIFF" and header[8:12] == b"WEBP",
+    "image/heic": is_heif,
+    "image/heif": is_heif,
+}
+
+def matches_image_signature(content_type: str, header: bytes) -> bool:
+    check = IMAGE_SIGNATURE_CHECKS.get(content_type)
+    return check is not None and check(header)
+
+def validate_image_upload(file: UploadFile):
+    check_upload_size(file)
+    if file.content_type not in ALLOWED_IMAGE_TYPES:
+        raise HTTPException(status_code=415, detail="Unsupported file type. Please upload a JPEG, PNG, WebP, HEIC or GIF image.")
+    file.file.seek(0)
+    header = file.file.read(12)
+    file.file.seek(0)
+    if not matches_image_signature(file.content_type, header):
+        raise HTTPException(status_code=415, detail="The uploaded file is not a valid image.")
+
 # --- Pydantic Models for Form Data ---
 class ContactForm(BaseModel):
     name: str
@@ -137,35 +298,265 @@ class TextManualRequest(BaseModel):
     query: str
     language: str
 
+# A bounded batch size keeps one request from monopolizing GEMINI_SEM.
+MAX_BATCH_ITEMS = 20
+
+class BatchTextManualRequest(BaseModel):
+    items: list[TextManualRequest] = Field(..., min_length=1, max_length=MAX_BATCH_ITEMS)
+
 # Note: We no longer use a Pydantic model for the chat, as it now uses FormData
 
+# --- Helper Functions for Uploads ---
+# Starlette already spools multipart uploads into a SpooledTemporaryFile
+# (in memory for small files, on disk for large ones), so the helpers below
+# read UploadFile.file in place instead of copying it anywhere else.
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+def upload_digest(file: UploadFile) -> str:
+    hasher = image_digest()
+    size = 0
+    file.file.seek(0)
+    while chunk := file.file.read(UPLOAD_CHUNK_SIZE):
+        size += len(chunk)
+        if size > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail=UPLOAD_TOO_LARGE_DETAIL)
+        hasher.update(chunk)
+    file.file.seek(0)
+    return hasher.hexdigest()
+
+def upload_mime_type(file: UploadFile) -> str:
+    if file.content_type and file.content_type.startswith("image/"):
+        return file.content_type
+    return "image/jpeg"
+
+def image_digest() -> hashlib.blake2b:
+    return hashlib.blake2b(digest_size=16)
+
+# --- Helper Function for Shrinking Images Before Upload ---
+# Phone photos are often several MB, but Gemini downsizes anything larger than
+# its 1568px tile anyway. Re-encoding to a bounded JPEG keeps the upload small.
+IMAGE_MAX_DIMENSION = 1568
+IMAGE_JPEG_QUALITY = 85
+IMAGE_RECOMPRESS_MIN_BYTES = 300 * 1024
+# Pillow only refuses images above ~179 MP and merely warns below that, while
+# PNG/WebP/GIF are always decoded at full size. Anything that would still
+# decode to more than this many pixels is rejected (~160 MB as RGBA).
+IMAGE_MAX_DECODE_PIXELS = 40_000_000
+
+if not features.check_feature("libjpeg_turbo"):
+    logger.warning("Pillow is not built with libjpeg-turbo; JPEG decode will be slower.")
+
+def compress_image(image_file, mime_type: str):
+    image_file.seek(0, os.SEEK_END)
+    size = image_file.tell()
+    image_file.seek(0)
+    if size < IMAGE_RECOMPRESS_MIN_BYTES and mime_type in GEMINI_IMAGE_TYPES:
+        return image_file, mime_type
+
+    try:
+        # Image.open only parses the header, so size/format are free to read.
+        img = Image.open(image_file)
+        if img.format == "JPEG":
+            if max(img.size) <= IMAGE_MAX_DIMENSION:
+                image_file.seek(0)
+                return image_file, mime_type
+            # Let libjpeg decode at a reduced scale instead of full resolution.
+            img.draft("RGB", (IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION))
+        # img.size is the header size, or the reduced draft size for JPEGs.
+        if img.width * img.height > IMAGE_MAX_DECODE_PIXELS:
+            raise Image.DecompressionBombError(f"{img.width}x{img.height} exceeds the decode limit")
+        # The re-encoded JPEG carries no EXIF, so apply the orientation tag to
+        # the pixels or portrait phone photos reach Gemini sideways.
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.Resampling.LANCZOS)
+    except Image.DecompressionBombError:
+        # A small file can declare enormous dimensions; refuse it before decoding.
+        raise HTTPException(status_code=413, detail="Image dimensions are too large.")
+    except (UnidentifiedImageError, OSError) as e:
+        # Formats Pillow can't decode (e.g. HEIC) are sent to Gemini as-is.
+        logger.info("Skipping image re-compression: %s", e)
+        image_file.seek(0)
+        return image_file, mime_type
+    if img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info:
+        # JPEG has no alpha; flatten onto white so transparent product shots
+        # don't turn black around a dark device.
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        img = background
+    elif img.mode != "RGB":
+        img = img.convert("RGB")
+
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True, progressive=True)
+    buf.seek(0)
+    return buf, "image/jpeg"
+
+# Builds an inline image part for Gemini from the upload's encoded bytes. The
+# image is only decoded by Pillow when compress_image() needs to shrink it.
+def inline_image_part(file: UploadFile) -> dict:
+    image_file, mime_type = compress_image(file.file, upload_mime_type(file))
+    return {"mime_type": mime_type, "data": image_file.read()}
+
+# --- Helper Function for the Gemini Files API Cache ---
+# Uploaded images are stored once on Gemini's Files API and the returned handle
+# is reused (keyed by content hash), so retries and language switches for the
+# same photo send a small file reference instead of the whole image.
+# Gemini keeps uploaded files for 48h; evict a little earlier than that.
+# A handle is dropped as soon as a generation using it fails, in case the file
+# was deleted on Gemini's side, so the next attempt uploads it again.
+GEMINI_FILE_TTL_SECONDS = 47 * 3600
+GEMINI_FILE_CACHE_MAX_ENTRIES = 256
+_gemini_file_cache: TTLCache = TTLCache(maxsize=GEMINI_FILE_CACHE_MAX_ENTRIES, ttl=GEMINI_FILE_TTL_SECONDS)
+_gemini_file_cache_lock = threading.Lock()
+
+def get_gemini_file(image_file, digest: str, mime_type: str):
+    with _gemini_file_cache_lock:
+        cached_file = _gemini_file_cache.get(digest)
+    if cached_file is not None:
+        return cached_file
+
+    upload_file, upload_type = compress_image(image_file, mime_type)
+    # Images are at most 10 MB (usually ~300 KB once compressed), so a single
+    # multipart upload beats the resumable init + PUT round trips.
+    gemini_file = get_genai().upload_file(upload_file, mime_type=upload_type, resumable=False)
+    with _gemini_file_cache_lock:
+        _gemini_file_cache[digest] = gemini_file
+    return gemini_file
+
+def forget_gemini_file(digest: str):
+    with _gemini_file_cache_lock:
+        _gemini_file_cache.pop(digest, None)
+
+# --- SMTP Connection Pool ---
+# Keeps a few logged-in SMTP sessions around so a burst of emails pays the
+# TLS handshake + AUTH once instead of per message. Sessions idle for a while
+# are checked with NOOP before reuse (send_email reconnects if a fresher one
+# still turns out dead) and recycled after sitting idle too long. Each session
+# is also retired after SMTP_MAX_MESSAGES_PER_SESSION sends, so one long-lived
+# session doesn't hit the server's per-connection message limit mid-burst.
+SMTP_HOST = "smtp.gmail.com"
+SMTP_PORT = 465
+SMTP_POOL_SIZE = 4
+SMTP_MAX_IDLE_SECONDS = 300
+SMTP_NOOP_AFTER_IDLE_SECONDS = 30
+SMTP_MAX_MESSAGES_PER_SESSION = 100
+# Bounds each socket operation so a stalled server can't pin a worker thread.
+SMTP_TIMEOUT_SECONDS = 20
+# Loading the system CA store is slow; build the TLS context once.
+SSL_CONTEXT = ssl.create_default_context()
+# Pool entries are (session, last used, messages sent on it).
+_smtp_pool: "queue.Queue[tuple[smtplib.SMTP_SSL, float, int]]" = queue.Queue(maxsize=SMTP_POOL_SIZE)
+
+def open_smtp_connection() -> smtplib.SMTP_SSL:
+    server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=SSL_CONTEXT, timeout=SMTP_TIMEOUT_SECONDS)
+    server.login(SENDER_EMAIL, SENDER_APP_PASSWORD)
+    return server
+
+def close_smtp_connection(server: smtplib.SMTP_SSL):
+    try:
+        server.quit()
+    except (smtplib.SMTPException, OSError):
+        server.close()
+
+def acquire_smtp_connection() -> tuple[smtplib.SMTP_SSL, int]:
+    while True:
+        try:
+            server, last_used, sent = _smtp_pool.get_nowait()
+        except queue.Empty:
+            return open_smtp_connection(), 0
+        idle = time.monotonic() - last_used
+        if idle > SMTP_MAX_IDLE_SECONDS:
+            close_smtp_connection(server)
+            continue
+        if idle < SMTP_NOOP_AFTER_IDLE_SECONDS:
+            return server, sent
+        try:
+            if server.noop()[0] == 250:
+                return server, sent
+        except (smtplib.SMTPException, OSError):
+            pass
+        close_smtp_connection(server)
+
+def release_smtp_connection(server: smtplib.SMTP_SSL, sent: int):
+    if sent >= SMTP_MAX_MESSAGES_PER_SESSION:
+        close_smtp_connection(server)
+        return
+    try:
+        _smtp_pool.put_nowait((server, time.monotonic(), sent))
+    except queue.Full:
+        close_smtp_connection(server)
+
+def close_smtp_pool():
+    while True:
+        try:
+            server, _, _ = _smtp_pool.get_nowait()
+        except queue.Empty:
+            return
+        close_smtp_connection(server)
+
 # --- Helper Function for Sending Email ---
+# The sender header never changes; format it once.
+FROM_HEADER = f"{YOUR_NAME} <{SENDER_EMAIL}>"
+
 def send_email(subject: str, body: str, reply_to: EmailStr = None):
     try:
         msg = EmailMessage()
         msg['Subject'] = subject
-        msg['From'] = f"{YOUR_NAME} <{SENDER_EMAIL}>"
+        msg['From'] = FROM_HEADER
         msg['To'] = SENDER_EMAIL
         if reply_to:
             msg['Reply-To'] = reply_to
         msg.set_content(body)
 
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465, context=context) as server:
-            server.login(SENDER_EMAIL, SENDER_APP_PASSWORD)
-            server.send_message(msg)
-        print(f"Successfully sent email: {subject}")
+        server, sent = acquire_smtp_connection()
+        try:
+            try:
+                server.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                close_smtp_connection(server)
+                server, sent = open_smtp_connection(), 0
+                server.send_message(msg)
+        except Exception:
+            close_smtp_connection(server)
+            raise
+        release_smtp_connection(server, sent + 1)
+        logger.info("Successfully sent email: %s", subject)
         return True
-    except Exception as e:
-        print(f"--- EMAIL SENDING FAILED ---")
-        print(f"Error: {e}")
+    except Exception:
+        logger.exception("Email sending failed: %s", subject)
         return False
 
 # --- Helper Function for Google Image Search ---
+# Building the Custom Search client is slow and its HTTP connection is worth
+# keeping, but it is not thread-safe, so each worker thread reuses its own.
+# Found image URLs are cached for a few hours per normalized query.
+IMAGE_URL_CACHE_TTL_SECONDS = 6 * 3600
+
+_search_local = threading.local()
+_image_url_cache: TTLCache = TTLCache(maxsize=2048, ttl=IMAGE_URL_CACHE_TTL_SECONDS)
+_image_url_cache_lock = threading.Lock()
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+def get_search_service():
+    service = getattr(_search_local, "service", None)
+    if service is None:
+        from googleapiclient.discovery import build
+
+        service = build("customsearch", "v1", developerKey=CUSTOM_SEARCH_API_KEY, cache_discovery=False)
+        _search_local.service = service
+    return service
+
 def get_image_url(query: str) -> Optional[str]:
+    key = normalize_query(query)
+    with _image_url_cache_lock:
+        cached_url = _image_url_cache.get(key)
+    if cached_url is not None:
+        return cached_url
     try:
-        service = build("customsearch", "v1", developerKey=CUSTOM_SEARCH_API_KEY)
-        result = service.cse().list(
+        result = get_search_service().cse().list(
             q=query,
             cx=SEARCH_ENGINE_ID,
             searchType="image",
@@ -174,86 +565,500 @@ def get_image_url(query: str) -> Optional[str]:
         ).execute()
         
         if "items" in result and len(result["items"]) > 0:
-            return result["items"][0]["link"]
+            image_url = result["items"][0]["link"]
+            with _image_url_cache_lock:
+                _image_url_cache[key] = image_url
+            return image_url
         else:
             return None
-    except Exception as e:
-        print(f"Error during image search: {e}")
+    except Exception:
+        logger.exception("Error during image search for %r", query)
         return None
 
+# --- Helper Function for Formatted System Prompts ---
+# Prompts for the languages offered in the UI are formatted once at startup.
+# Any other language string is formatted on demand and never cached, so odd
+# client input can't push the common prompts out.
+SUPPORTED_LANGUAGES = (
+    "English", "Spanish", "French", "German", "Hindi", "Japanese",
+    "Korean", "Portuguese", "Russian", "Chinese (Mandarin)",
+)
+SYSTEM_PROMPTS = {
+    (template, language): template.format(language=language)
+    for template in (
+        MANUAL_SYSTEM_PROMPT_TEMPLATE,
+        TEXT_MANUAL_SYSTEM_PROMPT_TEMPLATE,
+        CHAT_SYSTEM_PROMPT_TEMPLATE,
+    )
+    for language in SUPPORTED_LANGUAGES
+}
+
+def format_system_prompt(template: str, language: str) -> str:
+    prompt = SYSTEM_PROMPTS.get((template, language))
+    if prompt is None:
+        prompt = template.format(language=language)
+    return prompt
+
+# --- Helper Functions for Cached Gemini Models ---
+# Building a GenerativeModel per request is pure overhead; keep one per language.
+# (Gemini's explicit prompt caching isn't used: these system prompts are a few
+# hundred tokens, well under its minimum cacheable size.)
+@functools.lru_cache(maxsize=64)
+def get_manual_model(language: str) -> "genai.GenerativeModel":
+    return get_genai().GenerativeModel(
+        model_name=GEMINI_MODEL_NAME,
+        system_instruction=format_system_prompt(MANUAL_SYSTEM_PROMPT_TEMPLATE, language),
+        generation_config=GENERATION_CONFIG,
+        safety_settings=SAFETY_SETTINGS,
+    )
+
+@functools.lru_cache(maxsize=64)
+def get_text_manual_model(language: str) -> "genai.GenerativeModel":
+    return get_genai().GenerativeModel(
+        model_name=GEMINI_MODEL_NAME,
+        system_instruction=format_system_prompt(TEXT_MANUAL_SYSTEM_PROMPT_TEMPLATE, language),
+        generation_config=GENERATION_CONFIG,
+        safety_settings=SAFETY_SETTINGS,
+    )
+
+@functools.lru_cache(maxsize=64)
+def get_chat_model(language: str) -> "genai.GenerativeModel":
+    return get_genai().GenerativeModel(
+        model_name=GEMINI_MODEL_NAME,
+        system_instruction=format_system_prompt(CHAT_SYSTEM_PROMPT_TEMPLATE, language),
+        generation_config=GENERATION_CONFIG,
+        safety_settings=SAFETY_SETTINGS,
+    )
+
+# --- Helper Function for Reading Gemini Responses ---
+# `.text` joins every part on each access and raises if a response/chunk has no
+# text parts (blocked, or only a finish reason), so read it once through here.
+def response_text(response) -> str:
+    if not response:
+        return ""
+    try:
+        return response.text
+    except ValueError:
+        return ""
+
+# Anything but STOP (SAFETY, RECITATION, MAX_TOKENS, ...) means the text was
+# cut short and must not be served or cached as a finished manual. Chunks
+# before the last one report no finish reason (None here).
+def finish_reason(response) -> Optional[str]:
+    candidates = getattr(response, "candidates", None)
+    if not candidates or not candidates[0].finish_reason:
+        return None
+    reason = candidates[0].finish_reason
+    return getattr(reason, "name", str(reason))
+
+def truncated_message(reason: Optional[str]) -> str:
+    return f"The response was cut off before it finished (reason: {reason or 'unknown'})."
+
+# --- Helper Function for Manual Generation from an Image ---
+# Used by the Celery worker task; the /generate-manual/ endpoint streams the
+# same request through generate_content_async instead.
+MANUAL_USER_PROMPT = "Please identify this device and generate its manual."
+
+def generate_manual_text(image_part, language: str) -> Optional[str]:
+    response = get_manual_model(language).generate_content([MANUAL_USER_PROMPT, image_part])
+    manual_text = response_text(response)
+    if manual_text and finish_reason(response) != "STOP":
+        raise RuntimeError(truncated_message(finish_reason(response)))
+    return manual_text or None
+
+# --- Helper Functions for Gemini Errors ---
+# Map Gemini API failures to meaningful status codes so clients can tell
+# "back off and retry" (429/503/504) apart from "don't retry" (400).
+def gemini_error_status(e: Exception) -> int:
+    from google.api_core import exceptions as google_exceptions
+
+    if isinstance(e, google_exceptions.ResourceExhausted):
+        return 429
+    if isinstance(e, google_exceptions.InvalidArgument):
+        return 400
+    if isinstance(e, google_exceptions.DeadlineExceeded):
+        return 504
+    if isinstance(e, google_exceptions.ServiceUnavailable):
+        return 503
+    return 500
+
+def gemini_http_exception(e: Exception) -> HTTPException:
+    return HTTPException(status_code=gemini_error_status(e), detail=f"An error occurred: {e}")
+
+# --- Gemini Concurrency Limit ---
+# Caps in-flight Gemini generations per worker process so a burst of uploads
+# queues here instead of tripping the API rate limit with a wave of 429s.
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "8"))
+GEMINI_SEM = asyncio.Semaphore(GEMINI_CONCURRENCY)
+
+# If Gemini still answers 429/503, retry a couple of times with jittered
+# exponential backoff (1s, 2s, ...) so workers that got throttled together
+# don't all come back at the same moment. The GEMINI_SEM slot is kept while
+# waiting, which also slows this worker down while the API is saturated.
+GEMINI_MAX_RETRIES = 2
+GEMINI_RETRY_BASE_SECONDS = 1.0
+
+def gemini_retry_delay(e: Exception, attempt: int) -> Optional[float]:
+    if attempt >= GEMINI_MAX_RETRIES or gemini_error_status(e) not in (429, 503):
+        return None
+    return GEMINI_RETRY_BASE_SECONDS * 2 ** attempt * random.uniform(0.5, 1.5)
+
+# --- Manual Response Cache ---
+# Popular devices get asked about over and over (same stock photo, same device
+# name). Finished manuals are kept in memory keyed by (kind, image hash or
+# query, language), so repeats skip the multi-second Gemini call entirely.
+# Entries expire after a day so improved prompts/models eventually show up.
+MANUAL_CACHE_TTL_SECONDS = 24 * 3600
+MANUAL_CACHE: TTLCache = TTLCache(maxsize=1024, ttl=MANUAL_CACHE_TTL_SECONDS)
+
+def text_manual_cache_key(item: TextManualRequest) -> tuple:
+    return ("text", normalize_query(item.query), item.language)
+
+# Identical text queries that arrive together would all miss the cache and
+# each call Gemini. Generation for a key runs under a per-key lock; whoever
+# waits on it finds the finished manual in MANUAL_CACHE. Each entry holds the
+# lock and a count of its users and is removed when nobody holds it.
+_manual_locks: dict[tuple, list] = {}
+
+@contextlib.asynccontextmanager
+async def manual_generation_lock(cache_key: tuple):
+    entry = _manual_locks.get(cache_key)
+    if entry is None:
+        entry = _manual_locks[cache_key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _manual_locks[cache_key]
+
+# --- Helper Functions for Server-Sent Events ---
+# Streamed endpoints send one `data: {...}` JSON event per Gemini chunk
+# ({"text": ...}) and a final {"error": ..., "status": ...} event if generation
+# fails midway.
+# /generate-manual-from-text/ also sends one {"image_url": ...} event, in
+# whatever position the image search finishes.
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+# Events are built by hand (not by FastAPI's response serialization), so they
+# use orjson, which is faster per chunk and writes UTF-8 instead of \u escapes.
+def sse_event(payload: dict) -> str:
+    return f"data: {orjson.dumps(payload).decode()}\n\n"
+
+def sse_response(events) -> StreamingResponse:
+    return StreamingResponse(events, media_type="text/event-stream", headers=SSE_HEADERS)
+
+async def stream_gemini_events(start_stream, cache_key=None, on_error=None):
+    # `start_stream` returns the generate_content_async(..., stream=True)
+    # coroutine; a GEMINI_SEM slot is held for the whole stream. A completed
+    # manual is stored under `cache_key` in MANUAL_CACHE; `on_error` is called
+    # if the Gemini call ultimately fails.
+    # An SSE comment goes out first so buffering proxies pass the response
+    # through right away, even while waiting for a GEMINI_SEM slot.
+    # Retries only happen before any text has been sent to the client.
+    yield ": open\n\n"
+    async with GEMINI_SEM:
+        parts = []
+        attempt = 0
+        while True:
+            try:
+                reason = None
+                response = await start_stream()
+                async for chunk in response:
+                    reason = finish_reason(chunk) or reason
+                    text = response_text(chunk)
+                    if text:
+                        parts.append(text)
+                        yield sse_event({"text": text})
+                break
+            except Exception as e:
+                delay = None if parts else gemini_retry_delay(e, attempt)
+                if delay is None:
+                    logger.exception("Gemini stream failed")
+                    if on_error is not None:
+                        on_error()
+                    yield sse_event({"error": f"An error occurred: {e}", "status": gemini_error_status(e)})
+                    return
+                logger.warning("Gemini throttled (%s); retrying in %.1fs", e, delay)
+                attempt += 1
+                await asyncio.sleep(delay)
+        if not parts:
+            yield sse_event({"error": "Failed to generate content or response was blocked."})
+        elif reason != "STOP":
+            logger.warning("Gemini stream ended early: %s", reason)
+            yield sse_event({"error": truncated_message(reason)})
+        elif cache_key is not None:
+            MANUAL_CACHE[cache_key] = "".join(parts)
+
+async def text_events(text: str):
+    yield sse_event({"text": text})
+
+# --- Celery Task Queue ---
+# Gemini work can be offloaded to dedicated workers so HTTP workers are not
+# held for the whole LLM round trip. Run workers for each queue with:
+#   celery -A backend.main:celery_app worker -Q gemini_queue -c 8 -Ofair
+#   celery -A backend.main:celery_app worker -Q mail_queue -c 2
+#
+# With GEMINI_QUEUE_SHARDS=N (N > 1) manual jobs are spread over gemini_q_0 ..
+# gemini_q_{N-1} by a consistent hash of the image, so retries of the same photo
+# land on the same worker (whose Files API cache is already warm). Start one
+# worker per shard, e.g. `-Q gemini_q_0`.
+#
+# Celery is only imported when CELERY_BROKER_URL is set; without it the task
+# functions below stay plain functions and the job endpoints return 503.
+GEMINI_QUEUE_SHARDS = int(os.getenv("GEMINI_QUEUE_SHARDS", "1"))
+
+celery_app = None
+if CELERY_BROKER_URL:
+    from celery import Celery
+    from celery.signals import worker_process_init, worker_process_shutdown
+
+    celery_app = Celery("digihelp", broker=CELERY_BROKER_URL, backend=CELERY_RESULT_BACKEND)
+    celery_app.conf.update(
+        task_serializer="json",
+        result_serializer="json",
+        accept_content=["json"],
+        result_expires=3600,
+        # Gemini calls are long; don't let one worker reserve jobs another could run.
+        worker_prefetch_multiplier=1,
+    )
+
+    @worker_process_init.connect
+    def start_worker_logging(**kwargs):
+        _log_listener.start()
+
+    @worker_process_shutdown.connect
+    def stop_worker_logging(**kwargs):
+        close_smtp_pool()
+        _log_listener.stop()
+
+def jump_consistent_hash(key: int, num_buckets: int) -> int:
+    # Lamping & Veach's jump hash: only ~1/N keys move when a shard is added.
+    bucket, j = -1, 0
+    while j < num_buckets:
+        bucket = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+def gemini_queue_for(digest: str) -> str:
+    if GEMINI_QUEUE_SHARDS <= 1:
+        return "gemini_queue"
+    return f"gemini_q_{jump_consistent_hash(int(digest, 16), GEMINI_QUEUE_SHARDS)}"
+
+def generate_manual_task(image_b64: str, mime_type: str, language: str):
+    image_bytes = base64.b64decode(image_b64)
+    hasher = image_digest()
+    hasher.update(image_bytes)
+    digest = hasher.hexdigest()
+    gemini_file = get_gemini_file(io.BytesIO(image_bytes), digest, mime_type)
+    try:
+        manual_text = generate_manual_text(gemini_file, language)
+    except Exception:
+        forget_gemini_file(digest)
+        raise
+    if not manual_text:
+        raise RuntimeError("Failed to generate content or response was blocked.")
+    return {"manual_text": manual_text, "image_url": None}
+
+def send_email_task(subject: str, body: str, reply_to: Optional[str] = None):
+    return send_email(subject, body, reply_to=reply_to)
+
+if celery_app is not None:
+    generate_manual_task = celery_app.task(queue="gemini_queue")(generate_manual_task)
+    send_email_task = celery_app.task(queue="mail_queue")(send_email_task)
+
 # --- API Endpoints ---
 
-@app.get("/")
-def read_root():
-    return {"message": "Device DigiHelp AI Backend is running."}
+# Liveness probe: a fixed plain-text body, and HEAD for probes that send it.
+@app.api_route("/", methods=["GET", "HEAD"], response_class=PlainTextResponse)
+async def read_root():
+    return "ok"
 
 @app.post("/generate-manual/")
 async def generate_manual(
     language: str = Form("English"),
     file: UploadFile = File(...)
 ):
+    validate_image_upload(file)
     try:
-        image_bytes = await file.read()
-        img = Image.open(io.BytesIO(image_bytes))
-        dynamic_system_prompt = MANUAL_SYSTEM_PROMPT_TEMPLATE.format(language=language)
-        safety_settings = [
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-        ]
-        instructed_model = genai.GenerativeModel(
-            model_name="gemini-2.5-flash-preview-09-2025",
-            system_instruction=dynamic_system_prompt
-        )
-        user_prompt_text = "Please identify this device and generate its manual."
-        response = instructed_model.generate_content(
-            [user_prompt_text, img],
-            generation_config=generation_config,
-            safety_settings=safety_settings,
-            stream=False,
-        )
-        if response and response.text:
-            return {"manual_text": response.text, "image_url": None} # No image URL needed here
-        else:
-            raise HTTPException(status_code=500, detail="Failed to generate content or response was blocked.")
+        digest = await asyncio.to_thread(upload_digest, file)
+        cache_key = ("image", digest, language)
+        cached_manual = MANUAL_CACHE.get(cache_key)
+        if cached_manual is not None:
+            return sse_response(text_events(cached_manual))
+        gemini_file = await asyncio.to_thread(get_gemini_file, file.file, digest, upload_mime_type(file))
+        # The first call per process imports the Gemini SDK, so keep it off the loop.
+        instructed_model = await asyncio.to_thread(get_manual_model, language)
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"An error occurred: {e}")
-        raise HTTPException(status_code=500, detail=f"An error occurred: {e}")
+        logger.exception("Failed to prepare image manual request")
+        raise gemini_http_exception(e)
+    start_stream = functools.partial(
+        instructed_model.generate_content_async,
+        [MANUAL_USER_PROMPT, gemini_file],
+        stream=True,
+    )
+    return sse_response(stream_gemini_events(
+        start_stream, cache_key, on_error=functools.partial(forget_gemini_file, digest),
+    ))
+
+# --- Background Manual Job Endpoints (Celery) ---
+@app.post("/generate-manual-job/")
+async def generate_manual_job(
+    language: str = Form("English"),
+    file: UploadFile = File(...)
+):
+    if not CELERY_BROKER_URL:
+        raise HTTPException(status_code=503, detail="Background job queue is not configured.")
+    validate_image_upload(file)
+    digest = await asyncio.to_thread(upload_digest, file)
+    # Shrink the photo before base64-encoding it into the broker message; the
+    # worker then gets an image compress_image() passes through untouched.
+    image_part = await asyncio.to_thread(inline_image_part, file)
+    image_b64 = base64.b64encode(image_part["data"]).decode("ascii")
+    task = await asyncio.to_thread(
+        generate_manual_task.apply_async,
+        args=(image_b64, image_part["mime_type"], language),
+        queue=gemini_queue_for(digest),
+    )
+    return {"job_id": task.id}
+
+@app.get("/result/{job_id}")
+def get_manual_job_result(job_id: str):
+    if not CELERY_BROKER_URL:
+        raise HTTPException(status_code=503, detail="Background job queue is not configured.")
+    result = celery_app.AsyncResult(job_id)
+    if not result.ready():
+        return {"status": "pending"}
+    if result.failed():
+        raise HTTPException(status_code=500, detail=f"An error occurred: {result.result}")
+    return {"status": "done", **result.result}
 
 # --- Generate Manual from Text Endpoint ---
 @app.post("/generate-manual-from-text/")
 async def generate_manual_from_text(request: TextManualRequest):
     try:
-        image_url = get_image_url(request.query) 
-        
-        dynamic_system_prompt = TEXT_MANUAL_SYSTEM_PROMPT_TEMPLATE.format(language=request.language)
-        safety_settings = [
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-        ]
-        instructed_model = genai.GenerativeModel(
-            model_name="gemini-2.5-flash-preview-09-2025",
-            system_instruction=dynamic_system_prompt
-        )
-        response = instructed_model.generate_content(
-            [request.query],
-            generation_config=generation_config,
-            safety_settings=safety_settings,
-            stream=False,
-        )
-
-        if response and response.text:
-            return {"manual_text": response.text, "image_url": image_url}
-        else:
-            raise HTTPException(status_code=500, detail="Failed to generate content or response was blocked.")
-
+        # The first call per process imports the Gemini SDK, so keep it off the loop.
+        instructed_model = await asyncio.to_thread(get_text_manual_model, request.language)
     except Exception as e:
-        print(f"An error occurred: {e}")
-        raise HTTPException(status_code=500, detail=f"An error occurred: {e}")
+        logger.exception("Failed to prepare text manual request")
+        raise gemini_http_exception(e)
+
+    start_stream = functools.partial(
+        instructed_model.generate_content_async,
+        [request.query],
+        stream=True,
+    )
+
+    cache_key = text_manual_cache_key(request)
 
+    async def event_stream():
+        # The image search runs alongside generation instead of in front of it;
+        # its event goes out as soon as it has finished.
+        image_task = asyncio.ensure_future(asyncio.to_thread(get_image_url, request.query))
+        image_sent = False
+        async with manual_generation_lock(cache_key):
+            cached_manual = MANUAL_CACHE.get(cache_key)
+            events = (
+                text_events(cached_manual) if cached_manual is not None
+                else stream_gemini_events(start_stream, cache_key)
+            )
+            async for event in events:
+                if not image_sent and image_task.done():
+                    yield sse_event({"image_url": image_task.result()})
+                    image_sent = True
+                yield event
+        if not image_sent:
+            yield sse_event({"image_url": await image_task})
+
+    return sse_response(event_stream())
+
+
+# --- Batch Generate Manuals from Text Endpoint ---
+# Generates manuals for several devices in one round trip; the Gemini calls run
+# concurrently (still bounded by GEMINI_SEM) and results keep the input order.
+# Shares MANUAL_CACHE entries with /generate-manual-from-text/.
+async def generate_text_manual(item: TextManualRequest) -> str:
+    cache_key = text_manual_cache_key(item)
+    async with manual_generation_lock(cache_key):
+        cached_manual = MANUAL_CACHE.get(cache_key)
+        if cached_manual is not None:
+            return cached_manual
+        instructed_model = await asyncio.to_thread(get_text_manual_model, item.language)
+        async with GEMINI_SEM:
+            attempt = 0
+            while True:
+                try:
+                    response = await instructed_model.generate_content_async([item.query])
+                    break
+                except Exception as e:
+                    delay = gemini_retry_delay(e, attempt)
+                    if delay is None:
+                        raise
+                    attempt += 1
+                    await asyncio.sleep(delay)
+        manual_text = response_text(response)
+        if not manual_text:
+            raise RuntimeError("Failed to generate content or response was blocked.")
+        if finish_reason(response) != "STOP":
+            raise RuntimeError(truncated_message(finish_reason(response)))
+        MANUAL_CACHE[cache_key] = manual_text
+        return manual_text
+
+@app.post("/generate-manuals-batch/")
+async def generate_manuals_batch(request: BatchTextManualRequest):
+    # Items that normalize to the same cache key are generated once and the
+    # result is repeated for each of them.
+    keys = [text_manual_cache_key(item) for item in request.items]
+    unique_items = dict(zip(keys, request.items))
+    outcomes = dict(zip(unique_items, await asyncio.gather(
+        *(generate_text_manual(item) for item in unique_items.values()),
+        return_exceptions=True,
+    )))
+    return {"results": [
+        {"error": f"An error occurred: {result}", "status": gemini_error_status(result)}
+        if isinstance(result, Exception) else {"manual_text": result}
+        for result in (outcomes[key] for key in keys)
+    ]}
+
+
+# --- Chat Topicality Guard ---
+# The chat prompt already makes Gemini refuse unrelated questions, but that
+# still costs a full model call. An English text-only question is refused
+# locally only when the whole question is one of a few unmistakable chit-chat
+# forms ("tell me a joke", "who are you", "what's the weather today", ...)
+# and it doesn't mention the device ("this", "it", "my", or a word of its
+# name). Everything else goes to Gemini; an unfamiliar word is never a reason
+# to refuse.
+CHAT_OFF_TOPIC_REPLY = "I can help only with questions about this device."
+CHAT_CHITCHAT_RE = re.compile(
+    r"(?:(?:hi|hello|hey)[\s,!.]+)?(?:please\s+)?(?:"
+    r"tell me (?:a|another) joke|(?:tell me )?a joke"
+    r"|what(?:['’]s| is) the weather(?: like)?(?: today| tomorrow)?"
+    r"|who are you|what(?:['’]s| is) your name|how are you(?: doing)?(?: today)?"
+    r"|are you (?:a )?(?:human|real|bot|robot)|who (?:made|created|built) you"
+    r"|what(?:['’]s| is) the capital of [a-z ]+|who won the world cup(?: in \d{4})?"
+    r"|what(?:['’]s| is) the meaning of life"
+    r"|write (?:me )?(?:a )?(?:poem|story|essay|song)(?: about [a-z ]+)?"
+    r")[\s?.!]*",
+    re.IGNORECASE,
+)
+CHAT_WORD_RE = re.compile(r"[a-z0-9]+")
+CHAT_DEVICE_REFERENCES = frozenset({"this", "it", "its", "my", "device"})
+CHAT_NAME_STOPWORDS = frozenset({"a", "an", "the", "your", "of", "and", "for", "with"})
+
+def chat_words(text: str) -> set[str]:
+    return set(CHAT_WORD_RE.findall(text.lower()))
+
+def is_off_topic_question(device: str, question: str, language: str) -> bool:
+    if language != "English" or not CHAT_CHITCHAT_RE.fullmatch(question.strip()):
+        return False
+    device_words = (chat_words(device) - CHAT_NAME_STOPWORDS) | CHAT_DEVICE_REFERENCES
+    return not chat_words(question) & device_words
 
 # --- AI Chatbot Endpoint (NOW MULTIMODAL) ---
 @app.post("/ask-follow-up/")
@@ -263,56 +1068,40 @@ async def ask_follow_up(
     language: str = Form("English"),
     file: Optional[UploadFile] = File(None) # Optional image file
 ):
-    
+    if file:
+        validate_image_upload(file)
+    elif is_off_topic_question(device, question, language):
+        return sse_response(text_events(CHAT_OFF_TOPIC_REPLY))
     try:
-        dynamic_chat_prompt = CHAT_SYSTEM_PROMPT_TEMPLATE.format(language=language)
-        chat_model = genai.GenerativeModel(
-            model_name="gemini-2.5-flash-preview-09-2025",
-            system_instruction=dynamic_chat_prompt
-        )
-        safety_settings = [
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-        ]
+        chat_model = await asyncio.to_thread(get_chat_model, language)
         prompt_parts = []
         prompt_parts.append(f"Device Context: {device}")
         
         if file:
-            if not file.content_type.startswith("image/"):
-                raise HTTPException(status_code=400, detail="Invalid file type for chat. Please upload an image.")
-            image_bytes = await file.read()
-            img = Image.open(io.BytesIO(image_bytes))
+            image_part = await asyncio.to_thread(inline_image_part, file)
             prompt_parts.append("Here is an image related to my question:")
-            prompt_parts.append(img)
+            prompt_parts.append(image_part)
         
         prompt_parts.append(f"User Question: {question}")
-        
-        response = chat_model.generate_content(
-            prompt_parts,
-            generation_config=generation_config,
-            safety_settings=safety_settings
-        )
-        
-        if response and response.text:
-            return {"answer": response.text}
-        else:
-            raise HTTPException(status_code=500, detail="AI failed to generate a chat response.")
-            
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error in chat follow-up: {e}")
-        raise HTTPException(status_code=500, detail=f"An error occurred: {e}")
+        logger.exception("Failed to prepare chat follow-up request")
+        raise gemini_http_exception(e)
+
+    start_stream = functools.partial(
+        chat_model.generate_content_async,
+        prompt_parts,
+        stream=True,
+    )
+    return sse_response(stream_gemini_events(start_stream))
 
 
 # --- Contact Form Submit Endpoint ---
 @app.post("/contact-submit/")
-async def submit_contact_form(form_data: ContactForm):
+async def submit_contact_form(form_data: ContactForm, background_tasks: BackgroundTasks):
     try:
-        print(f"--- NEW CONTACT FORM SUBMISSION ---")
-        print(f"Name: {form_data.name}")
-        print(f"Email: {form_data.email}")
-        print(f"Message: {form_data.message}")
+        logger.info("New contact form submission from %s <%s>", form_data.name, form_data.email)
         subject = f"New Contact Form from {form_data.name}"
         body = f"""
         You received a new contact form submission:
@@ -323,13 +1112,28 @@ async def submit_contact_form(form_data: ContactForm):
         Message:
         {form_data.message}
         """
-        send_email(subject, body, reply_to=form_data.email)
-        print(f"---------------------------------")
+        # Deliver after the response is sent; SMTP takes seconds, and even
+        # publishing to the Celery broker is a blocking network round trip.
+        deliver = send_email_task.delay if CELERY_BROKER_URL else send_email
+        background_tasks.add_task(deliver, subject, body, reply_to=form_data.email)
         return {"status": "success", "message": "Contact form received!"}
-    except Exception as e:
-        print(f"Error in contact form: {e}")
+    except Exception:
+        logger.exception("Error processing contact form")
         raise HTTPException(status_code=500, detail="Error processing contact form.")
 
 # 5. Run the App
+# Multiple workers need an import string rather than the app object; app_dir
+# lets this work no matter which directory the script is started from.
+# The work is I/O-bound and async, so one worker per core is enough;
+# WEB_CONCURRENCY (the conventional name hosts set) overrides it.
 if __name__ == "__main__":
-    uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
+    uvicorn.run(
+        "main:app",
+        app_dir=os.path.dirname(os.path.abspath(__file__)),
+        host=os.getenv("HOST", "127.0.0.1"),
+        port=int(os.getenv("PORT", "8000")),
+        workers=int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1))),
+        # uvloop isn't available on Windows; httptools is.
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+    )